@@ -1,92 +1,217 @@
+import hashlib
 import streamlit as st
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sns
+import xlsxwriter
 from io import BytesIO
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+# Relative-grading cut points in units of std around the mean (ascending) and
+# the grade for each bucket np.digitize maps a score into.
+_REL_Z = np.array([-2, -5 / 3, -4 / 3, -1, -0.5, 0.5, 1, 1.5], dtype=np.float64)
+_REL_LABELS = np.array(["F", "C-", "C", "C+", "B-", "B", "B+", "A-", "A"])
+
 
 # --- Helper Functions ---
 
-def calculate_absolute_grades(scores, thresholds):
+@st.cache_data(persist="disk", show_spinner=False, max_entries=16)
+def load_scores_file(digest, name, _file_bytes):
     """
-    Assign grades based on absolute grade thresholds.
+    Parse an uploaded CSV or Excel file into a DataFrame.
+
+    The cache is keyed on the file's digest and name; the raw bytes are passed
+    as an unhashed argument so Streamlit does not have to hash them again.
     """
-    grades = []
-    for score in scores:
-        for grade, threshold in thresholds.items():
-            if score >= threshold:
-                grades.append(grade)
-                break
-    return grades
+    if name.endswith(".csv"):
+        return pd.read_csv(BytesIO(_file_bytes))
+    return pd.read_excel(BytesIO(_file_bytes), engine=EXCEL_ENGINE)
 
 
+@st.cache_data(persist="disk", show_spinner=False, max_entries=16)
+def calculate_absolute_grades(scores, labels, cutoffs):
+    """
+    Assign grades from parallel arrays of grade labels and minimum scores.
+    """
+    # Reverse before the stable sort so that, on tied cutoffs, the grade
+    # listed first ends up last and wins the lookup.
+    thr = np.asarray(cutoffs, dtype=np.float32)[::-1]
+    labels = np.asarray(labels)[::-1]
+    order = np.argsort(thr, kind="stable")
+    thr_sorted = thr[order]
+    labels_sorted = labels[order]
+
+    arr = np.ascontiguousarray(scores, dtype=np.float32)
+    idx = np.searchsorted(thr_sorted, arr, side="right") - 1
+    return labels_sorted[np.clip(idx, 0, None)].tolist()
+
+
+@st.cache_data(persist="disk", show_spinner=False, max_entries=16)
 def calculate_relative_grades(scores, mean, std):
     """
     Assign grades using mean and standard deviation (predefined formula).
     """
-    grade_boundaries = {
-        "A": (mean + 1.5 * std, mean + 2 * std),
-        "A-": (mean + std, mean + 1.5 * std),
-        "B+": (mean + 0.5 * std, mean + std),
-        "B": (mean - 0.5 * std, mean + 0.5 * std),
-        "B-": (mean - std, mean - 0.5 * std),
-        "C+": (mean - (4 / 3) * std, mean - std),
-        "C": (mean - (5 / 3) * std, mean - (4 / 3) * std),
-        "C-": (mean - 2 * std, mean - (5 / 3) * std),
-        "D": (mean - 2 * std, None),
-        "F": (None, mean - 2 * std),
-    }
-
-    grades = []
-    for score in scores:
-        assigned = False
-        for grade, (lower, upper) in grade_boundaries.items():
-            if (lower is None or score >= lower) and (upper is None or score < upper):
-                grades.append(grade)
-                assigned = True
-                break
-        if not assigned:
-            grades.append("F")
-
-    return grades
+    bins = (mean + std * _REL_Z).astype(np.float32)
+    arr = np.ascontiguousarray(scores, dtype=np.float32)
+    return _REL_LABELS[np.digitize(arr, bins)].tolist()
 
 
+@st.cache_data(persist="disk", show_spinner=False, max_entries=16)
 def calculate_relative_grades_percentile(scores, percentages):
     """
     Assign grades using user-defined percentages for each grade.
     """
-    scores_sorted = scores.sort_values(ascending=False).reset_index(drop=True)
-    n = len(scores)
-    grades = pd.Series(index=scores.index, dtype="object")
+    arr = np.ascontiguousarray(scores, dtype=np.float32)
+    # 0-based rank of each score, highest score first; inverting the sort
+    # permutation with a scatter avoids a second argsort.
+    order = (-arr).argsort(kind="stable")
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(arr.size)
+    cutoffs = np.ceil(np.cumsum(list(percentages.values())) / 100 * arr.size).astype(np.int64)
+    labels = np.array(list(percentages.keys()), dtype=object)
+
+    grade_idx = np.searchsorted(cutoffs, ranks, side="right")
+    return labels[np.clip(grade_idx, 0, len(labels) - 1)].tolist()
 
-    cumulative_percentage = 0
-    start_index = 0
-    for grade, percentage in percentages.items():
-        cumulative_percentage += percentage
-        end_index = int(np.ceil(cumulative_percentage / 100 * n))
-        grades[scores_sorted.index[start_index:end_index]] = grade
-        start_index = end_index
 
-    return grades
+@st.cache_data
+def export_to_csv(df):
+    """
+    Export data to CSV bytes.
+    """
+    return df.to_csv(index=False, lineterminator="\n").encode("utf-8")
 
 
+def _excel_value(value):
+    """
+    Map a cell value to what xlsxwriter can write, as to_excel did for missing and infinite values.
+    """
+    if isinstance(value, float) and np.isinf(value):
+        return "inf" if value > 0 else "-inf"
+    return None if pd.isna(value) else value
+
+
+@st.cache_data
 def export_to_excel(df):
     """
     Export data to an Excel file.
     """
+    num_rows, num_cols = len(df) + 1, len(df.columns)
+    if num_rows > 1048576 or num_cols > 16384:
+        raise ValueError(
+            f"This sheet is too large! Your sheet size is: {num_rows}, {num_cols} "
+            f"Max sheet size is: 1048576, 16384")
+
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False)
+    # Rows are written in order, so constant_memory can flush each one as the next starts.
+    # The default date format keeps datetime cells from showing up as serial numbers.
+    workbook = xlsxwriter.Workbook(
+        output, {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"})
+    worksheet = workbook.add_worksheet("Grades")
+    worksheet.write_row(0, 0, [str(column) for column in df.columns], workbook.add_format({"bold": True}))
+    for row, values in enumerate(df.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row, 0, [_excel_value(value) for value in values])
+    workbook.close()
     return output
 
 
+@njit(cache=True)
+def _bin_counts(values, lo, hi, bins):
+    counts = np.zeros(bins)
+    scale = bins / (hi - lo)
+    for x in values:
+        idx = int((x - lo) * scale)
+        if idx == bins:
+            idx -= 1
+        if 0 <= idx < bins:
+            counts[idx] += 1.0
+    return counts
+
+
+def fast_kde(values, grid_size=256):
+    """
+    Estimate a Gaussian KDE on a regular grid by binning the values and
+    convolving the counts with the kernel through an FFT.
+    """
+    bw = values.std(ddof=1) * values.size ** (-1 / 5)  # Scott's rule
+    lo = values.min() - 3 * bw
+    hi = values.max() + 3 * bw
+    counts = _bin_counts(values, lo, hi, grid_size)
+
+    dx = (hi - lo) / grid_size
+    n_fft = 2 * grid_size
+    offsets = np.fft.fftfreq(n_fft, d=1 / n_fft) * dx
+    kernel = np.exp(-0.5 * (offsets / bw) ** 2) / (bw * np.sqrt(2 * np.pi))
+    density = np.fft.irfft(np.fft.rfft(counts, n_fft) * np.fft.rfft(kernel), n_fft)[:grid_size]
+
+    xs = lo + (np.arange(grid_size) + 0.5) * dx
+    return xs, density / values.size
+
+
+def plot_distribution(ax, scores, color):
+    """
+    Draw a density histogram of the scores with a KDE curve overlaid.
+    """
+    values = np.asarray(scores, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return
+    if values.min() == values.max():
+        ax.hist(values, bins=15, density=True, alpha=0.5, color=color)
+        return
+
+    bins = np.linspace(values.min(), values.max(), 16)
+    ax.hist(values, bins=bins, density=True, alpha=0.5, color=color)
+    xs, density = fast_kde(values)
+    ax.plot(xs, density, color=color)
+
+
+def get_figure():
+    """
+    Return this session's reusable figure and axes, cleared for a new plot.
+    """
+    if "figure" not in st.session_state:
+        # A bare Figure isn't registered with pyplot, so it is freed along with the session
+        fig = Figure()
+        st.session_state.figure = (fig, fig.subplots())
+    fig, ax = st.session_state.figure
+    ax.cla()
+    return fig, ax
+
+
+def mean_and_std(scores):
+    """
+    Compute the mean and sample standard deviation of non-missing scores.
+    """
+    arr = np.ascontiguousarray(scores, dtype=np.float64)
+    n = arr.size
+    if n < 2:
+        return (float(arr.sum()) if n else np.nan), np.nan
+    # The variance sums squared deviations from the mean rather than subtracting
+    # n * mean**2, which cancels badly for tight columns
+    mean = arr.sum() / n
+    centred = arr - mean
+    var = np.einsum("i,i->", centred, centred) / (n - 1)
+    return float(mean), float(np.sqrt(var))
+
+
 def standardize_scores(scores):
     """
     Standardize scores to have a mean of 0 and a standard deviation of 1.
     """
-    mean_score = scores.mean()
-    std_score = scores.std()
+    mean_score, std_score = mean_and_std(scores.dropna())
     standardized_scores = (scores - mean_score) / std_score
     return standardized_scores
 
@@ -100,16 +225,21 @@ st.header("1. Upload Student Scores")
 file = st.file_uploader("Upload a CSV or Excel file containing student scores.", type=["csv", "xlsx"])
 
 if file is not None:
-    if file.name.endswith(".csv"):
-        data = pd.read_csv(file)
-    else:
-        data = pd.read_excel(file)
+    file_bytes = file.getvalue()
+    data = load_scores_file(hashlib.sha1(file_bytes).hexdigest(), file.name, file_bytes)
 
     if "Scores" not in data.columns:
         st.error("The file must contain a column named 'Scores'.")
     else:
         st.success("File uploaded successfully!")
-        scores = data["Scores"]
+        # Scores keep their original precision here; the grading helpers narrow to float32 internally
+        scores = pd.to_numeric(data["Scores"], errors="coerce")
+
+        # Grade only the rows that actually have a score; the rest are left without a grade
+        valid_scores = scores.dropna()
+        if valid_scores.empty:
+            st.error("The 'Scores' column does not contain any numeric scores.")
+            st.stop()
 
         # Step 2: Choose Grading Scheme
         st.header("2. Choose Grading Scheme")
@@ -122,27 +252,17 @@ if file is not None:
             st.subheader("Define Absolute Grade Boundaries")
             custom_boundaries = st.checkbox("Define your own grade boundaries", value=False)
 
+            labels = ["A", "A-", "B+", "B", "B-", "C+", "C", "C-", "D", "F"]
             if custom_boundaries:
-                thresholds = {}
-                for grade in ["A", "A-", "B+", "B", "B-", "C+", "C", "C-", "D", "F"]:
-                    thresholds[grade] = st.number_input(
-                        f"Enter minimum percentage for {grade}", min_value=0.0, max_value=100.0, step=0.1)
+                cutoffs = np.array([
+                    st.number_input(f"Enter minimum percentage for {grade}", min_value=0.0, max_value=100.0, step=0.1)
+                    for grade in labels
+                ], dtype=np.float32)
             else:
-                thresholds = {
-                    "A": 90,
-                    "A-": 85,
-                    "B+": 80,
-                    "B": 75,
-                    "B-": 70,
-                    "C+": 65,
-                    "C": 60,
-                    "C-": 55,
-                    "D": 50,
-                    "F": 0,
-                }
-                st.write("Using default boundaries:", thresholds)
-
-            grades = calculate_absolute_grades(scores, thresholds)
+                cutoffs = np.array([90, 85, 80, 75, 70, 65, 60, 55, 50, 0], dtype=np.float32)
+                st.write("Using default boundaries:", dict(zip(labels, cutoffs.tolist())))
+
+            grades = calculate_absolute_grades(valid_scores.to_numpy(), labels, cutoffs)
 
             # No need for standardized scores in absolute grading
             standardized_scores = scores
@@ -174,73 +294,78 @@ if file is not None:
                     percentages = {"A": percentage_a, "F": percentage_f}
                     percentages.update({grade: proportional_percentage for grade in remaining_grades})
 
-                    grades = calculate_relative_grades_percentile(scores, percentages)
+                    grades = calculate_relative_grades_percentile(valid_scores.to_numpy(), percentages)
 
                     # Standardize scores before applying the grading calculation
                     standardized_scores = standardize_scores(scores)
 
             else:  # Predefined Formula
-                mean = scores.mean()
-                std = scores.std()
+                if valid_scores.min() == valid_scores.max():
+                    st.error("Relative grading needs at least two distinct scores.")
+                    st.stop()
+                mean, std = mean_and_std(valid_scores)
                 st.write(f"Using default boundaries: Mean = {mean:.2f}, Std Dev = {std:.2f}")
 
-                # Standardize scores before applying the grading calculation
-                standardized_scores = standardize_scores(scores)
-                standardized_mean = standardized_scores.mean()
-                standardized_std = standardized_scores.std()
-                st.write(f"Standardized scores: Mean = {standardized_mean:.2f}, Std Dev = {standardized_std:.2f}")
-                grades = calculate_relative_grades(standardized_scores, standardized_mean, standardized_std)
+                # Standardize once with the statistics above; the z-scores have mean 0 and std 1 by construction
+                standardized_scores = (scores - mean) / std
+                grades = calculate_relative_grades(standardized_scores.loc[valid_scores.index].to_numpy(), 0.0, 1.0)
 
         data["Standardized Scores"] = standardized_scores
-        data["Grades"] = grades
+        data["Grades"] = pd.Series(grades, index=valid_scores.index)
+
+        # Explicit grade order; casting up front lets value_counts and sorting use the category codes
+        grade_order = ["A", "A-", "B+", "B", "B-", "C+", "C", "C-", "D", "F"]
+        data["Grades"] = pd.Categorical(data["Grades"], categories=grade_order, ordered=True)
 
         # Step 3: Visualizations
         st.header("3. Visualizations")
 
         # Original Score Distribution
         st.subheader("Original Score Distribution")
-        fig, ax = plt.subplots()
-        sns.histplot(scores, kde=True, ax=ax, color="blue")
+        fig, ax = get_figure()
+        plot_distribution(ax, scores, color="blue")
         ax.set_title("Original Score Distribution")
         st.pyplot(fig)
 
         # Standardized Score Distribution
         st.subheader("Standardized Score Distribution")
-        fig, ax = plt.subplots()
-        sns.histplot(standardized_scores, kde=True, ax=ax, color="green")
+        fig, ax = get_figure()
+        plot_distribution(ax, standardized_scores, color="green")
         ax.set_title("Standardized Score Distribution")
         st.pyplot(fig)
 
         # Grade Distribution
         st.subheader("Grade Distribution")
-        fig, ax = plt.subplots()
-        sns.countplot(x="Grades", data=data, order=["A", "A-", "B+", "B", "B-", "C+", "C", "C-", "D", "F"], ax=ax)
+        fig, ax = get_figure()
+        sns.countplot(x="Grades", data=data, order=grade_order, ax=ax)
         ax.set_title("Grade Distribution")
         st.pyplot(fig)
 
         # Summary statistics
         st.subheader("Summary Statistics")
-        summary = data["Grades"].value_counts().reset_index()
-        summary.columns = ["Grade", "Count"]
+        summary = data["Grades"].value_counts(sort=False).rename_axis("Grade").reset_index(name="Count")
         st.dataframe(summary)
 
-        # Explicit grade order for sorting
-        grade_order = ["A", "A-", "B+", "B", "B-", "C+", "C", "C-", "D", "F"]
-
-        # Convert the Grades column to a categorical type with the specified order
-        data["Grades"] = pd.Categorical(data["Grades"], categories=grade_order, ordered=True)
-
         # Sort the data by Grades
         data = data.sort_values("Grades")
 
         # Export results
         st.header("4. Export Results")
-        export_file = export_to_excel(data)
         st.download_button(
-            label="Download Grades as Excel",
-            data=export_file.getvalue(),
-            file_name="graded_students.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            label="Download Grades as CSV",
+            data=export_to_csv(data),
+            file_name="graded_students.csv",
+            mime="text/csv"
         )
 
+        # The Excel workbook is slower to build, so only prepare it when asked
+        if st.checkbox("Also prepare an Excel file", value=False):
+            export_file = export_to_excel(data)
+            st.download_button(
+                label="Download Grades as Excel",
+                data=export_file.getvalue(),
+                file_name="graded_students.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+
         st.success("Grading process completed successfully!")